@@ -0,0 +1,207 @@
+""" As-of alignment of several packet streams into one wide table.
+
+    The first stream is the base: every one of its rows gives one output row,
+    and each other stream contributes the row nearest before (backward),
+    nearest after (forward) or nearest either way (nearest) in time,
+    optionally within a tolerance. Output columns are named pid_column, with
+    pid_datetime giving the time of the matched row of each other stream.
+
+    Streams are iterables of DataFrame chunks sorted by datetime, so data is
+    merged chunk by chunk and never needs to fit in memory as a whole.
+"""
+import collections
+import numpy as np
+import pandas as pd
+import packet_parser
+
+ALIGN_CHUNK_SIZE = 100000   # stream rows read at a time
+# seconds of base stream aligned at a time, bounds rows of other streams
+# held in memory
+ALIGN_MAX_SPAN = 600.0
+
+ALIGN_METHODS = ('backward', 'forward', 'nearest')
+
+
+def align_packet_streams(decoded, spec, how='backward', tolerance=None,
+                         chunksize=ALIGN_CHUNK_SIZE):
+    """ Align decoded DataFrames (dict of pid: parsed DataFrame) according
+        to spec, list of (pid, [columns]) pairs or OrderedDict. First pid is
+        the base stream. Tolerance is in seconds.
+        Returns aligned DataFrame.
+    """
+    spec = collections.OrderedDict(spec)
+    streams = collections.OrderedDict(
+        (pid, iter_df_chunks(decoded[pid][_with_datetime(cols)], chunksize))
+        for pid, cols in spec.items())
+
+    chunks = list(iter_aligned(streams, how, tolerance))
+    return pd.concat(chunks) if chunks else pd.DataFrame()
+
+
+def iter_df_chunks(df, chunksize=ALIGN_CHUNK_SIZE):
+    """ Yields DataFrame in chunks of chunksize rows.
+    """
+    for i in range(0, len(df), chunksize):
+        yield df.iloc[i:i + chunksize]
+
+
+def iter_csv_chunks(fname, columns, chunksize=ALIGN_CHUNK_SIZE):
+    """ Yields chunks of datetime and specified columns from parsed CSV.
+    """
+    return pd.read_csv(fname, chunksize=chunksize,
+                       usecols=_with_datetime(columns))
+
+
+def _with_datetime(columns):
+    return ['datetime'] + [col for col in columns if col != 'datetime']
+
+
+def iter_aligned(streams, how='backward', tolerance=None,
+                 max_span=ALIGN_MAX_SPAN):
+    """ Align streams, OrderedDict of name: iterable of DataFrame chunks with
+        datetime column, each sorted by time. First stream is the base, its
+        chunks are aligned max_span seconds at a time.
+        Yields aligned DataFrame chunks indexed like the base stream.
+    """
+    if how not in ALIGN_METHODS:
+        raise ValueError('how must be one of {}'.format(ALIGN_METHODS))
+    tolerance_ns = None if tolerance is None else int(tolerance * 1e9)
+
+    names = list(streams)
+    base = _StreamBuffer(names[0], streams[names[0]])
+    others = [_StreamBuffer(name, streams[name]) for name in names[1:]]
+
+    max_span_ns = int(max_span * 1e9)
+
+    for base_chunk in base.chunks:
+        chunk_times = base.check_times(base_chunk)
+        for lo, hi in _split_span(chunk_times, max_span_ns):
+            times = chunk_times[lo:hi]
+            piece = base_chunk.iloc[lo:hi]
+
+            aligned = [piece[['datetime']],
+                       base.prefixed(piece.drop('datetime', axis=1))]
+            for other in others:
+                other.fill_past(times[-1])
+                rows = _match_rows(other.times, times, how, tolerance_ns)
+                aligned.append(other.take(rows, piece.index))
+                other.drop_before(times[-1])
+
+            yield pd.concat(aligned, axis=1)
+
+
+def _split_span(times, max_span_ns):
+    """ Returns list of (start, stop) row ranges of sorted times, each
+        spanning at most max_span_ns.
+    """
+    ranges = []
+    lo = 0
+    while lo < len(times):
+        hi = np.searchsorted(times, times[lo] + max_span_ns, 'right')
+        ranges.append((lo, hi))
+        lo = hi
+    return ranges
+
+
+class _StreamBuffer(object):
+    """ Rows of one stream read ahead of the base stream, as int64 times and
+        DataFrame of values.
+    """
+    def __init__(self, name, chunks):
+        self.name = name
+        self.chunks = iter(chunks)
+        self.times = np.empty(0, dtype=np.int64)
+        self.values = None
+        self.last_time = None
+        self.exhausted = False
+
+    def check_times(self, chunk):
+        times = packet_parser.to_timestamp_ns(chunk['datetime'])
+        if len(times):
+            if np.any(np.diff(times) < 0) or (
+                    self.last_time is not None and times[0] < self.last_time):
+                raise ValueError('Stream {} is not sorted by datetime'
+                                 .format(self.name))
+            self.last_time = times[-1]
+        return times
+
+    def prefixed(self, chunk):
+        return chunk.rename(
+            columns=lambda col: '{}_{}'.format(self.name, col))
+
+    def fill_past(self, t):
+        """ Read chunks until a row after time t is buffered (or no more).
+        """
+        times = [self.times]
+        values = [] if self.values is None else [self.values]
+        last = self.times[-1] if len(self.times) else None
+        while not self.exhausted and (last is None or last <= t):
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.exhausted = True
+                break
+            chunk_times = self.check_times(chunk)
+            if len(chunk_times):
+                last = chunk_times[-1]
+            times.append(chunk_times)
+            values.append(self.prefixed(chunk).reset_index(drop=True))
+
+        # concatenate once, not per chunk read
+        if len(times) > 1:
+            self.times = np.concatenate(times)
+            self.values = pd.concat(values, ignore_index=True)
+
+    def drop_before(self, t):
+        """ Forget rows no later base time than t can match, keeping the
+            last row at or before t for backward matches.
+        """
+        keep = max(np.searchsorted(self.times, t, 'right') - 1, 0)
+        if keep:
+            self.times = self.times[keep:]
+            self.values = self.values.iloc[keep:].reset_index(drop=True)
+
+    def take(self, rows, index):
+        """ Returns buffered values at rows (-1 for no match gives NaN),
+            with index of base chunk.
+        """
+        if self.values is None:
+            return pd.DataFrame(index=index)
+        taken = self.values.reindex(rows)
+        taken.index = index
+        return taken
+
+
+def _match_rows(other_times, times, how, tolerance_ns):
+    """ Returns int array of row of other_times matching each of times by
+        method how, -1 where nothing matches.
+    """
+    n = len(other_times)
+    if not n:
+        return np.full(len(times), -1, dtype=np.int64)
+
+    before = np.searchsorted(other_times, times, 'right') - 1
+    after = np.searchsorted(other_times, times, 'left')
+    has_before = before >= 0
+    has_after = after < n
+
+    dist_before = np.where(has_before,
+                           times - other_times[before.clip(0, n - 1)], -1)
+    dist_after = np.where(has_after,
+                          other_times[after.clip(0, n - 1)] - times, -1)
+
+    if how == 'backward':
+        rows, dist, valid = before, dist_before, has_before
+    elif how == 'forward':
+        rows, dist, valid = after, dist_after, has_after
+    else:
+        # prefer row before on ties
+        use_after = has_after & (~has_before | (dist_after < dist_before))
+        rows = np.where(use_after, after, before)
+        dist = np.where(use_after, dist_after, dist_before)
+        valid = has_before | has_after
+
+    if tolerance_ns is not None:
+        valid = valid & (dist <= tolerance_ns)
+
+    return np.where(valid, rows, -1)
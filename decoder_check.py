@@ -0,0 +1,377 @@
+""" Differential check and benchmark of packet decoders.
+
+    Generates random and edge case 64 byte packets for every packet format
+    definition in packet_formats, decodes them with the reference decoder
+    (packet_parser.parse_packet_str) and every other engine, and reports any
+    field whose value differs. Decode throughput of each engine is recorded
+    and can be saved as a baseline that later runs are checked against:
+
+        python decoder_check.py --save-baseline bench.json
+        python decoder_check.py --baseline bench.json --max-slowdown 0.2
+
+    Exit status is 1 on any mismatch, error while timing an engine, or
+    slowdown beyond the limit.
+
+    An engine takes (list of packet hex strings, packet format) and returns a
+    list of parsed value lists; add new ones with register_engine.
+"""
+import argparse
+import collections
+import json
+import random
+import struct
+import sys
+import time
+import packet_formats
+import packet_parser
+
+PACKET_BITS = 512
+
+# half precision words for float:16 corners: zeros, subnormals, smallest
+# normal, max, infinities, quiet/signalling NaNs
+FLOAT16_EDGE_WORDS = (0x0000, 0x8000, 0x0001, 0x8001, 0x0200, 0x03ff,
+                      0x83ff, 0x0400, 0x7bff, 0xfbff, 0x7c00, 0xfc00,
+                      0x7c01, 0x7e00, 0xfe00, 0x7fff, 0xffff)
+
+# 32 bit motpos words: [2 trash][6 high][8 trash][16 low], signed 22 bits
+MOTPOS_EDGE_WORDS = (0x00000000, 0xffffffff, 0xc0ff0000, 0x3f00ffff,
+                     0x20000000, 0x20000001, 0x1f00ffff, 0x00ff0000)
+
+# 32 bit motspd words: [16 skipped][8 speed, shifted right 2][8 skipped]
+MOTSPD_EDGE_WORDS = (0x00000000, 0xffffffff, 0x0000ff00, 0x00008000,
+                     0x00000300, 0xffff00ff, 0x00000400)
+
+# 44 byte text fields: leading/embedded/trailing NULs, blanks, bad utf-8
+TEXT_EDGE_VALUES = (b'\x00' * 44,
+                    b'\x00' * 43 + b'A',
+                    b'\x00\x00\x00start ivsweep #0001 - cell 1'.ljust(44),
+                    b'TaskStop  seqTask_110'.ljust(44, b'\x00'),
+                    b'a\x00b'.ljust(44, b' '),
+                    b' ' * 44,
+                    b'\x7f' * 44,
+                    b'\xff' + b'A' * 43)
+
+# no flight format has a motspd field, so this made up one puts every
+# special param type (and odd length signed ints) in a single 512 bit packet
+SYNTHETIC_PACKET_DEF = collections.OrderedDict()
+SYNTHETIC_PACKET_DEF['motor_speed'] = 'motspd'
+SYNTHETIC_PACKET_DEF['motor_position'] = 'motpos'
+SYNTHETIC_PACKET_DEF['temperature'] = 'float:16'
+SYNTHETIC_PACKET_DEF['ascii_data'] = 'text:352'
+SYNTHETIC_PACKET_DEF['int_12'] = 'int:12'
+SYNTHETIC_PACKET_DEF['uint_4'] = 'uint:4'
+SYNTHETIC_PACKET_DEF['int_31'] = 'int:31'
+SYNTHETIC_PACKET_DEF['int_33'] = 'int:33'
+
+ENGINES = collections.OrderedDict()
+
+
+def register_engine(name, decode):
+    """ Add engine decode(packets, packet_format) -> list of parsed lists.
+    """
+    ENGINES[name] = decode
+
+
+def per_packet_engine(parse):
+    """ Returns engine decoding packets one by one with
+        parse(packet_str, packet_format).
+    """
+    def decode(packets, packet_format):
+        return [parse(packet_str, packet_format) for packet_str in packets]
+    return decode
+
+
+register_engine('reference',
+                per_packet_engine(packet_parser.parse_packet_str))
+register_engine('int', per_packet_engine(packet_parser.parse_packet_int))
+
+
+def get_packet_formats():
+    """ Returns OrderedDict of name: packet format for every definition in
+        packet_formats, followed by SYNTHETIC_PACKET_DEF.
+    """
+    formats = collections.OrderedDict(
+        (name, getattr(packet_formats, name))
+        for name in sorted(dir(packet_formats)) if name.endswith('_DEF'))
+    formats['SYNTHETIC_PACKET_DEF'] = SYNTHETIC_PACKET_DEF
+    return formats
+
+
+# PACKET GENERATION
+
+def set_field(packet_int, pos, length, value):
+    """ Returns packet_int with length bits at bit offset pos set to value.
+    """
+    shift = PACKET_BITS - pos - length
+    mask = ((1 << length) - 1) << shift
+    return (packet_int & ~mask) | ((value << shift) & mask)
+
+
+def to_packet_str(packet_int):
+    return '{:0128x}'.format(packet_int)
+
+
+def random_text(rng):
+    """ Returns 44 byte EVR-like text: printable ascii padded with NULs or
+        blanks.
+    """
+    text = ''.join(chr(rng.randint(32, 126))
+                   for _ in range(rng.randint(0, 44)))
+    return text.ljust(44, rng.choice(('\x00', ' '))).encode('latin-1')
+
+
+def text_to_int(text):
+    return int(''.join('{:02x}'.format(ord(c)) for c in
+                       text.decode('latin-1')) or '0', 16)
+
+
+def random_packets(packet_format, count, rng):
+    """ Returns list of count random packet hex strings. Text fields get
+        printable text, since random bytes are almost never valid utf-8.
+    """
+    layout = packet_parser.get_packet_layout(packet_format)
+    packets = []
+    for _ in range(count):
+        packet_int = rng.getrandbits(PACKET_BITS)
+        for param_type, kind, pos, length in layout:
+            if kind == 'text':
+                packet_int = set_field(packet_int, pos, length,
+                                       text_to_int(random_text(rng)))
+        packets.append(to_packet_str(packet_int))
+    return packets
+
+
+def edge_case_packets(packet_format):
+    """ Returns list of packet hex strings exercising decoder corners: all
+        zero/one bits, alternating bits, and every edge value from the tables
+        above written into every field of the matching param type.
+    """
+    layout = packet_parser.get_packet_layout(packet_format)
+    ones = (1 << PACKET_BITS) - 1
+    bases = (0, ones, int('aa' * 64, 16), int('55' * 64, 16))
+    packets = [to_packet_str(base) for base in bases]
+
+    edge_values = (('float:16', FLOAT16_EDGE_WORDS),
+                   ('motpos', MOTPOS_EDGE_WORDS),
+                   ('motspd', MOTSPD_EDGE_WORDS),
+                   ('text:352', [text_to_int(t) for t in TEXT_EDGE_VALUES]))
+
+    for edge_type, values in edge_values:
+        fields = [(pos, length) for param_type, kind, pos, length in layout
+                  if param_type == edge_type]
+        if not fields:
+            continue
+        for base in (0, ones):
+            for value in values:
+                packet_int = base
+                for pos, length in fields:
+                    packet_int = set_field(packet_int, pos, length, value)
+                packets.append(to_packet_str(packet_int))
+
+    # sign bit only, and all but sign bit, for every signed int field
+    for param_type, kind, pos, length in layout:
+        if kind == 'int':
+            for value in (1 << (length - 1), (1 << (length - 1)) - 1):
+                packets.append(to_packet_str(set_field(0, pos, length,
+                                                       value)))
+
+    return packets
+
+
+# COMPARISON
+
+def decode_each(decode, packets, packet_format):
+    """ Decode packets one at a time so a packet the decoder rejects gives
+        its exception as result instead of stopping the run.
+        Returns list of parsed lists or exceptions.
+    """
+    results = []
+    for packet_str in packets:
+        try:
+            results.append(decode([packet_str], packet_format)[0])
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def same_value(ref, val):
+    """ True if val is exactly ref: floats compared bit for bit (NaNs and
+        signed zeros included), ints regardless of int/long, everything else
+        by type and value.
+    """
+    if isinstance(ref, float) or isinstance(val, float):
+        return (isinstance(ref, float) and isinstance(val, float) and
+                struct.pack('>d', ref) == struct.pack('>d', val))
+    if isinstance(ref, (int, long)) and not isinstance(ref, bool):
+        return isinstance(val, (int, long)) and ref == val
+    return type(ref) is type(val) and ref == val
+
+
+def diff_results(ref_results, results, packet_format):
+    """ Returns list of (packet index, field, reference value, engine value)
+        for every field that differs. A packet where either side raised
+        differs unless both raised the same exception type.
+    """
+    fields = list(packet_format)
+    diffs = []
+    for i, (ref, res) in enumerate(zip(ref_results, results)):
+        if isinstance(ref, Exception) or isinstance(res, Exception):
+            if type(ref) is not type(res):
+                diffs.append((i, None, ref, res))
+            continue
+        if len(ref) != len(res):
+            diffs.append((i, None, len(ref), len(res)))
+            continue
+        for field, ref_val, val in zip(fields, ref, res):
+            if not same_value(ref_val, val):
+                diffs.append((i, field, ref_val, val))
+    return diffs
+
+
+def measure_throughput(decode, packets, packet_format, min_time=0.2):
+    """ Returns packets decoded per second, repeating for at least
+        min_time seconds. Packets must all decode without error, see
+        run_checks.
+    """
+    count = 0
+    start = time.time()
+    while True:
+        decode(packets, packet_format)
+        count += len(packets)
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            return count / elapsed
+
+
+def run_checks(engines=None, formats=None, count=200, seed=0):
+    """ Diff every engine against the reference on random and edge case
+        packets of every format, and time each engine.
+        Each engine is timed only on packets both it and the reference
+        decoded without error; an error while timing is kept as 'error'
+        instead of stopping the run.
+        Returns nested dict {format: {engine: {'mismatches': [...],
+        'packets_per_sec': n, 'error': message or None}}}.
+    """
+    engines = engines or [name for name in ENGINES if name != 'reference']
+    formats = formats or get_packet_formats()
+    rng = random.Random(seed)
+
+    report = collections.OrderedDict()
+    for name, packet_format in formats.items():
+        packets = (edge_case_packets(packet_format) +
+                   random_packets(packet_format, count, rng))
+        ref_results = decode_each(ENGINES['reference'], packets,
+                                  packet_format)
+        good_packets = [p for p, r in zip(packets, ref_results)
+                        if not isinstance(r, Exception)]
+
+        report[name] = collections.OrderedDict()
+        for engine in ['reference'] + list(engines):
+            decode = ENGINES[engine]
+            entry = {'packets_per_sec': None, 'mismatches': [], 'error': None}
+            timed_packets = good_packets
+            if engine != 'reference':
+                results = decode_each(decode, packets, packet_format)
+                entry['mismatches'] = [
+                    (packets[i], field, repr(ref), repr(val))
+                    for i, field, ref, val in diff_results(
+                        ref_results, results, packet_format)]
+                timed_packets = [
+                    p for p, ref, res in zip(packets, ref_results, results)
+                    if not isinstance(ref, Exception) and
+                    not isinstance(res, Exception)]
+            if timed_packets:
+                try:
+                    entry['packets_per_sec'] = measure_throughput(
+                        decode, timed_packets, packet_format)
+                except Exception as e:
+                    entry['error'] = '{}: {}'.format(type(e).__name__, e)
+            report[name][engine] = entry
+
+    return report
+
+
+def find_slowdowns(report, baseline, max_slowdown):
+    """ Returns list of (format, engine, baseline rate, rate) where the
+        engine got more than max_slowdown (fraction) slower than baseline.
+    """
+    slowdowns = []
+    for name, engines in report.items():
+        for engine, entry in engines.items():
+            base_rate = baseline.get(name, {}).get(engine)
+            rate = entry['packets_per_sec']
+            if base_rate and rate and rate < base_rate * (1 - max_slowdown):
+                slowdowns.append((name, engine, base_rate, rate))
+    return slowdowns
+
+
+def main(argv=None):
+    """ Run checks from command line.
+        Returns exit status.
+    """
+    parser = argparse.ArgumentParser(
+        description='Diff packet decoders against the reference decoder and '
+        'measure their throughput.')
+    parser.add_argument('-e', '--engine', nargs='+', choices=list(ENGINES),
+                        help='engines to check (default: all)')
+    parser.add_argument('-f', '--format', nargs='+', metavar='NAME',
+                        help='packet format definitions (default: all)')
+    parser.add_argument('-n', '--count', type=int, default=200,
+                        help='random packets per format')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', metavar='JSON',
+                        help='throughput baseline to compare against')
+    parser.add_argument('--max-slowdown', type=float, default=0.2,
+                        help='allowed fractional slowdown vs baseline')
+    parser.add_argument('--save-baseline', metavar='JSON',
+                        help='save measured throughput as baseline')
+    args = parser.parse_args(argv)
+
+    formats = get_packet_formats()
+    if args.format:
+        unknown = [name for name in args.format if name not in formats]
+        if unknown:
+            parser.error('unknown format: {}'.format(', '.join(unknown)))
+        formats = collections.OrderedDict(
+            (name, formats[name]) for name in args.format)
+
+    report = run_checks(args.engine, formats, args.count, args.seed)
+    status = 0
+
+    print '{:<24}{:<12}{:>14}{:>12}'.format('format', 'engine',
+                                            'packets/s', 'mismatches')
+    for name, engines in report.items():
+        for engine, entry in engines.items():
+            rate = entry['packets_per_sec']
+            print '{:<24}{:<12}{:>14}{:>12}'.format(
+                name, engine, '-' if rate is None else int(rate),
+                len(entry['mismatches']))
+            for packet_str, field, ref, val in entry['mismatches'][:5]:
+                print '    {} {}: reference {} != {}'.format(
+                    packet_str, field, ref, val)
+            if entry['error']:
+                print '    error while timing: {}'.format(entry['error'])
+            if entry['mismatches'] or entry['error']:
+                status = 1
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for name, engine, base_rate, rate in find_slowdowns(
+                report, baseline, args.max_slowdown):
+            print 'SLOWER: {} {} {:.0f} -> {:.0f} packets/s'.format(
+                name, engine, base_rate, rate)
+            status = 1
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(dict((name, dict((engine, entry['packets_per_sec'])
+                                       for engine, entry in engines.items()))
+                           for name, engines in report.items()),
+                      f, indent=2, sort_keys=True)
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
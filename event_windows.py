@@ -0,0 +1,130 @@
+r""" Event windowing: pick out packets around EVR events instead of by row
+    number. A rule opens a window at an EVR whose ascii_data matches its
+    start pattern and closes it at the next EVR matching its stop pattern,
+    padded by a number of seconds on either side:
+
+        event_rule(r'start ivsweep', r'stop\s+ivsweep', pad_after=5)
+
+    Windows are resolved from the EVR stream once and packets are pulled out
+    of each decoded DataFrame by binary search on their timestamps.
+"""
+import collections
+import packet_parser
+
+# numpy and pandas are imported where used, so rules can be defined (as in
+# main.TRIM_RULES) without loading them
+
+EventRule = collections.namedtuple(
+    'EventRule', ['start', 'stop', 'pad_before', 'pad_after'])
+
+END_OF_TIME = 2 ** 63 - 1      # largest int64 nanosecond time
+
+
+def event_rule(start, stop=None, pad_before=0, pad_after=0):
+    """ Returns EventRule. start and stop are regular expressions searched
+        for in EVR ascii_data; with no stop the window is the start event
+        itself. Padding is in seconds.
+    """
+    return EventRule(start, stop, pad_before, pad_after)
+
+
+def find_event_windows(evr_df, rules):
+    """ Resolve rules against parsed EVR DataFrame (0x402).
+        A start with no later stop event leaves the window open to the end of
+        the data; further starts inside an open window are ignored.
+        Returns int64 array of [start, stop] nanosecond rows, sorted and with
+        overlapping windows merged.
+    """
+    import numpy as np
+
+    times = packet_parser.to_timestamp_ns(evr_df['datetime'])
+    order = np.argsort(times, kind='mergesort')
+    times = times[order]
+    text = evr_df['ascii_data'].fillna('').iloc[order].str
+
+    windows = []
+    for rule in rules:
+        start_idx = np.flatnonzero(text.contains(rule.start).values)
+        if rule.stop is None:
+            stop_idx = start_idx
+        else:
+            stop_idx = np.flatnonzero(text.contains(rule.stop).values)
+
+        pad_before = int(rule.pad_before * 1e9)
+        pad_after = int(rule.pad_after * 1e9)
+
+        # index into stop_idx of first stop event after each start event
+        next_stop = np.searchsorted(stop_idx, start_idx,
+                                    'left' if rule.stop is None else 'right')
+
+        window_end = -1
+        for start, i in zip(start_idx, next_stop):
+            if start <= window_end:
+                continue
+            if i < len(stop_idx):
+                window_end = stop_idx[i]
+                stop_time = times[window_end] + pad_after
+            else:
+                window_end = len(times)
+                stop_time = END_OF_TIME
+            windows.append([times[start] - pad_before, stop_time])
+
+    return merge_windows(windows)
+
+
+def merge_windows(windows):
+    """ Sort [start, stop] windows and merge any that overlap.
+        Returns int64 array of [start, stop] rows.
+    """
+    import numpy as np
+
+    windows = np.asarray(windows, dtype=np.int64).reshape(-1, 2)
+    windows = windows[np.argsort(windows[:, 0], kind='mergesort')]
+
+    merged = []
+    for start, stop in windows:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+
+    return np.array(merged, dtype=np.int64).reshape(-1, 2)
+
+
+def extract_windows(parsed_df, windows):
+    """ Returns rows of parsed DataFrame with datetime inside any of windows
+        (inclusive), in time order.
+    """
+    import numpy as np
+
+    times = packet_parser.to_timestamp_ns(parsed_df['datetime'])
+    order = np.argsort(times, kind='mergesort')
+    times = times[order]
+
+    lo = np.searchsorted(times, windows[:, 0], 'left')
+    hi = np.searchsorted(times, windows[:, 1], 'right')
+    rows = [order[l:h] for l, h in zip(lo, hi)]
+    if not rows:
+        return parsed_df.iloc[:0]
+    return parsed_df.iloc[np.concatenate(rows)]
+
+
+def trim_with_evr(parsed_df, evr_df, rules):
+    """ Trim parsed DataFrame to event windows from rules and interleave the
+        EVRs falling inside those windows (as main.add_evr_to_csv does).
+        Returns DataFrame with ascii_data as second column.
+    """
+    import numpy as np
+    import pandas as pd
+
+    windows = find_event_windows(evr_df, rules)
+
+    # specify order of columns (and drop anything not wanted)
+    cols = parsed_df.columns.insert(1, 'ascii_data')
+
+    trimmed_df = pd.concat([extract_windows(parsed_df, windows),
+                            extract_windows(evr_df, windows)])
+    times = packet_parser.to_timestamp_ns(trimmed_df['datetime'])
+    trimmed_df = trimmed_df.iloc[np.argsort(times, kind='mergesort')]
+
+    return trimmed_df[cols].reset_index(drop=True)
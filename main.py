@@ -1,26 +1,111 @@
+""" ORT boxcar data tool. Use the functions from an interactive session, or
+    from the command line:
+
+        python main.py inspect [PID ...]
+        python main.py decode 0x404 0x405 --delta
+        python main.py --help
+
+    pandas and friends are only imported by the commands that need them.
+"""
+import argparse
+import collections
+import os
+import sys
 import packet_parser
 import packet_formats
-import pandas as pd
+import event_windows
+
+
+# file names or glob patterns of boxcar files, in any order
+BOXCAR_GLOBS = packet_parser.BOXCAR_GLOBS
+
+# slowly varying state of health packets, exported change-only
+SOH_PID_LIST = ('0x403', '0x404', '0x405', '0x406', '0x407')
 
+# fields left out of change detection on top of
+# packet_parser.DELTA_IGNORE_FIELDS (spare words carry noise)
+DELTA_IGNORE = {
+    '0x405': ('word_26_spare', 'word_27_spare', 'word_28_spare',
+              'word_29_spare', 'word_30_spare', 'word_31_spare'),
+}
 
-BOXCAR_FILE_LIST = (
-    'rawdata/20160927_1218_1330_ROSA_ORT_DATA.dat',
-    'rawdata/20160927_1330_1430_ROSA_ORT_DATA.dat',
-    'rawdata/20160927_1430_1530_ROSA_ORT_DATA.dat',
-    'rawdata/20160927_1530_1630_ROSA_ORT_DATA.dat',
-    'rawdata/20160927_1630_1730_ROSA_ORT_DATA.dat',
-    'rawdata/20160927_1730_1831_ROSA_ORT_DATA.dat')
+# opt-in (decode --delta --deadband) tolerances: analog fields only count
+# as changed beyond these, so expanded values are approximate
+DELTA_DEADBAND = {
+    '0x404': {
+        'tcb_temperature': 0.5,
+        'mcb_1_temperature': 0.5,
+        'mcb_2_temperature': 0.5,
+        'atb_temperature': 0.5,
+        'ivb_temperature': 0.5,
+        'psb_3v3_bus_voltage': 0.05,
+        'psb_3v3_bus_current': 0.02,
+        'psb_3v3_bus_temperature': 0.5,
+        'psb_5v0_bus_voltage': 0.05,
+        'psb_5v0_bus_current': 0.02,
+        'psb_5v0_bus_temperature': 0.5,
+        'psb_12v_bus_voltage': 0.05,
+        'psb_12v_bus_current': 0.02,
+        'psb_12v_bus_temperature': 0.5,
+    },
+}
+
+# seconds kept either side of each event window
+TRIM_PAD = 5
+
+# EVR start/stop rules for event trimmed exports, see event_windows.event_rule.
+# 0x406 and 0x408 have no rules yet: their old slices hold no EVRs to key on.
+TRIM_RULES = {
+    # SSD - power on to power off
+    '0x404': [event_windows.event_rule(r'SSD_POWER_ON ssd=1',
+                                       r'SSD_POWER_OFF ssd=1',
+                                       TRIM_PAD, TRIM_PAD)],
+    # Cameras and experiment settings - cameras on to off, dynamics
+    # profile set-up to run, IV sweep set-up to sweep stop
+    '0x405': [event_windows.event_rule(r'TaskRun\s+seqTask_150',
+                                       r'TaskStop\s+seqTask_155',
+                                       TRIM_PAD, TRIM_PAD),
+              event_windows.event_rule(r'MOTOR_PROFILE_AMP',
+                                       r'MOTOR_PROFILE_RUN',
+                                       TRIM_PAD, TRIM_PAD),
+              event_windows.event_rule(r'IVB_IVSWEEP_(STEPS|START)',
+                                       r'IVB_IVSWEEP_STOP',
+                                       TRIM_PAD, TRIM_PAD)],
+    # MCB 2 limit switches and motors - motor sequences, enable to disable
+    '0x407': [event_windows.event_rule(r'TaskRun\s+seqTask_1[2-4]0',
+                                       r'TaskStop\s+seqTask_1[2-4]9',
+                                       TRIM_PAD, TRIM_PAD)],
+    # IV Sweep Data - each sweep
+    '0x409': [event_windows.event_rule(r'start\s+ivsweep', r'stop\s+ivsweep',
+                                       TRIM_PAD, TRIM_PAD)],
+    # Accelerometer Data - dynamics profile run until motor disabled
+    '0x411': [event_windows.event_rule(r'MOTOR_PROFILE_RUN',
+                                       r'TaskStop\s+seqTask_139',
+                                       TRIM_PAD, TRIM_PAD)],
+}
 
 
 # HELPER FUNCTIONS
 
-def load_ort_boxcar_data():
+def export_path(fname):
+    """ Returns path of fname in export directory.
+    """
+    return os.path.join(packet_parser.EXPORT_DIR, fname)
+
+
+def load_ort_boxcar_data(patterns=BOXCAR_GLOBS):
     """ Returns DataFrame with all boxcar data from ORT test with timestamp,
         packet id, and packet hex string (aka boxcar format)
         Header:  datetime, pid, packet_str
     """
+    import pandas as pd
+
+    fnames = packet_parser.find_boxcar_files(patterns)
+    if not fnames:
+        raise IOError('No boxcar files match {}'.format(', '.join(
+            packet_parser.get_iter_str_list(patterns))))
 
-    data = packet_parser.read_boxcar_file(*BOXCAR_FILE_LIST)
+    data = packet_parser.read_boxcar_file(*fnames)
     return pd.DataFrame(data, columns=['datetime', 'pid', 'packet_str'])
 
 
@@ -36,36 +121,73 @@ def process_boxcar_data(data, pid, pformat=None):
     return packet_parser.process_boxcar_df(data, pid, pformat)
 
 
-def csv_parsed_packet_list(pid_list):
+def csv_parsed_packet_list(pid_list, bc_data=None):
     """ Create CSV files for specified packet types. Uses default pformats
         unless otherwise specified.
     """
-    bc_data = load_ort_boxcar_data()
+    if bc_data is None:
+        bc_data = load_ort_boxcar_data()
 
     for pid in pid_list:
         print 'Parsing Packet Id: {}'.format(pid)
         parsed_df = process_boxcar_data(bc_data, pid)
-        parsed_df.to_csv('export/{}_parsed.csv'.format(pid))
+        parsed_df.to_csv(export_path('{}_parsed.csv'.format(pid)))
 
 
-def csv_parsed_packet_list_raw(pid_list):
+def csv_parsed_packet_list_raw(pid_list, bc_data=None):
     """ Create CSV files for specified packet types. Uses default pformats
         unless otherwise specified.
     """
-    bc_data = load_ort_boxcar_data()
+    if bc_data is None:
+        bc_data = load_ort_boxcar_data()
     raw_pformat = packet_formats.RAW_PACKET_DEF
     for pid in pid_list:
         print 'Parsing Packet Id: {}'.format(pid)
         parsed_df = process_boxcar_data(bc_data, pid, raw_pformat)
-        parsed_df.to_csv('export/{}_parsed_raw.csv'.format(pid))
+        parsed_df.to_csv(export_path('{}_parsed_raw.csv'.format(pid)))
+
+
+def csv_parsed_packet_list_delta(pid_list, fields=None, bc_data=None,
+                                 deadband=False):
+    """ Create change-only CSV files for specified packet types. A row is
+        written only when one of fields changes (default all fields except
+        counters and DELTA_IGNORE); with deadband, analog fields only by
+        more than DELTA_DEADBAND.
+    """
+    if bc_data is None:
+        bc_data = load_ort_boxcar_data()
+
+    for pid in pid_list:
+        print 'Parsing Packet Id: {}'.format(pid)
+        parsed_df = process_boxcar_data(bc_data, pid)
+        ignore = packet_parser.DELTA_IGNORE_FIELDS + DELTA_IGNORE.get(pid, ())
+        delta_df = packet_parser.delta_compress_df(
+            parsed_df, fields, ignore,
+            DELTA_DEADBAND.get(pid) if deadband else None)
+        print 'Rows kept: {} of {}'.format(len(delta_df), len(parsed_df))
+        delta_df.to_csv(export_path('{}_parsed_delta.csv'.format(pid)))
+
+
+def read_delta_csv(pid, datetimes=None):
+    """ Read change-only CSV for specified packet id and expand it to one
+        row per packet, or to values in effect at datetimes if specified.
+    """
+    import pandas as pd
+
+    delta_df = pd.read_csv(export_path('{}_parsed_delta.csv'.format(pid)),
+                           index_col=0)
+    return packet_parser.expand_delta_df(delta_df, datetimes)
 
 
 def add_evr_to_csv(pid_list):
     """ Opens CSV for specified packet id and adds EVRs
     """
+    import pandas as pd
+
     for pid in pid_list:
-        df = pd.read_csv('export/{}_parsed.csv'.format(pid), index_col=0)
-        evr_df = pd.read_csv('export/0x402_parsed.csv', index_col=0)
+        df = pd.read_csv(export_path('{}_parsed.csv'.format(pid)),
+                         index_col=0)
+        evr_df = pd.read_csv(export_path('0x402_parsed.csv'), index_col=0)
 
         # specify order of columns (and drop anything not wanted)
         cols = df.columns.insert(1, 'ascii_data')
@@ -73,10 +195,33 @@ def add_evr_to_csv(pid_list):
         new_df = pd.concat([df, evr_df]) \
             .sort_values(by='datetime').reset_index(drop=True)
 
-        new_df[cols].to_csv('export/{}_parsed_w_evr.csv'.format(pid))
+        new_df[cols].to_csv(export_path('{}_parsed_w_evr.csv'.format(pid)))
+
+
+def csv_aligned_packets(spec, outfile='aligned.csv', how='backward',
+                        tolerance=None):
+    """ Create one time-aligned CSV from parsed CSV files of several packet
+        ids. spec is list of (pid, [columns]) pairs, first pid giving the
+        output rows; see align.iter_aligned for how and tolerance (seconds).
+        Files are streamed in chunks, so they don't need to fit in memory.
+    """
+    import align
+
+    streams = collections.OrderedDict(
+        (pid, align.iter_csv_chunks(
+            export_path('{}_parsed.csv'.format(pid)), cols))
+        for pid, cols in spec)
+
+    header = True
+    for chunk in align.iter_aligned(streams, how, tolerance):
+        chunk.to_csv(export_path(outfile), header=header,
+                     mode='w' if header else 'a')
+        header = False
 
 
 def trim_packet_evr_csv_files():
+    import pandas as pd
+
     slice_list = {
         # SSD
         '0x404': [slice(17076, 17399)],
@@ -96,14 +241,44 @@ def trim_packet_evr_csv_files():
     }
 
     for pid, slices in slice_list.iteritems():
-        csv_df = pd.read_csv('export/{}_parsed_w_evr.csv'.format(pid),
+        csv_df = pd.read_csv(export_path('{}_parsed_w_evr.csv'.format(pid)),
                              index_col=0)
 
         dfs = []
         for slc in slices:
             dfs.append(csv_df.iloc[slc])
-        pd.concat(dfs).to_csv('export/{}_parsed_w_evr_trimmed.csv'
-                              .format(pid))
+        pd.concat(dfs).to_csv(export_path('{}_parsed_w_evr_trimmed.csv'
+                                          .format(pid)))
+
+
+def trim_packets_by_events(pid_rules=TRIM_RULES, decoded=None,
+                           bc_data=None):
+    """ Create trimmed CSV files with EVRs (pid_parsed_w_evr_events.csv,
+        next to the row slice trimmed files of trim_packet_evr_csv_files)
+        for each packet id in pid_rules, keeping only packets inside windows
+        of its EVR event rules.
+        Packets not in decoded (dict of pid: parsed DataFrame, including
+        EVRs, 0x402) are decoded from bc_data, loaded if not given.
+        Returns decoded dict, so new rule sets can be tried without decoding
+        again.
+    """
+    if decoded is None:
+        decoded = {}
+    missing = [pid for pid in list(pid_rules) + ['0x402']
+               if pid not in decoded]
+    if missing and bc_data is None:
+        bc_data = load_ort_boxcar_data()
+    for pid in missing:
+        print 'Parsing Packet Id: {}'.format(pid)
+        decoded[pid] = process_boxcar_data(bc_data, pid)
+
+    for pid, rules in pid_rules.iteritems():
+        trimmed_df = event_windows.trim_with_evr(decoded[pid],
+                                                 decoded['0x402'], rules)
+        trimmed_df.to_csv(export_path('{}_parsed_w_evr_events.csv'
+                                      .format(pid)))
+
+    return decoded
 
 
 # MAIN FUNCTIONS
@@ -119,6 +294,185 @@ def output_all_packet_ids():
     output_packet_id_list(all_pids)
 
 
+def output_soh_packets_as_delta():
+    csv_parsed_packet_list_delta(SOH_PID_LIST)
+
+
 def output_all_packets_as_raw():
     all_pids = packet_formats.packet_format_map.keys()
     csv_parsed_packet_list_raw(all_pids)
+
+
+# COMMAND LINE
+
+def cli(argv=None):
+    """ Run command line tool with argv (default sys.argv[1:]).
+        Returns exit status.
+    """
+    parser = argparse.ArgumentParser(
+        description='Read, decode and export ORT boxcar data.')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    def add_input_args(p):
+        p.add_argument('-i', '--input', nargs='+', default=BOXCAR_GLOBS,
+                       metavar='GLOB',
+                       help='boxcar files or glob patterns (default: %s)'
+                       % ' '.join(BOXCAR_GLOBS))
+        p.add_argument('-b', '--boxcar', metavar='PICKLE',
+                       help='boxcar data saved by ingest, instead of input')
+
+    p = commands.add_parser('inspect', help='list packet ids, formats and '
+                            'input files')
+    p.add_argument('pids', nargs='*', metavar='PID',
+                   help='show fields of these packet ids')
+    p.add_argument('-i', '--input', nargs='+', metavar='GLOB',
+                   help='list boxcar files matching these patterns')
+
+    p = commands.add_parser('ingest', help='load boxcar files, count packets '
+                            'and optionally save them for later commands')
+    add_input_args(p)
+    p.add_argument('-o', '--output', metavar='PICKLE',
+                   help='save boxcar data to this file')
+
+    p = commands.add_parser('decode', help='decode packet ids to CSV')
+    p.add_argument('pids', nargs='+', metavar='PID',
+                   help="packet ids, or 'all'")
+    add_input_args(p)
+    mode = p.add_mutually_exclusive_group()
+    mode.add_argument('--raw', action='store_true',
+                      help='export raw 16 bit words')
+    mode.add_argument('--delta', action='store_true',
+                      help='export change-only rows')
+    p.add_argument('--fields', nargs='+', metavar='FIELD',
+                   help='fields compared for --delta (default: all but '
+                   'counters and main.DELTA_IGNORE)')
+    p.add_argument('--deadband', action='store_true',
+                   help='with --delta, ignore analog changes within '
+                   'main.DELTA_DEADBAND (lossy)')
+
+    p = commands.add_parser('merge-evr', help='add EVRs to decoded CSVs')
+    p.add_argument('pids', nargs='+', metavar='PID')
+
+    p = commands.add_parser('trim', help='export packets inside EVR event '
+                            'windows (main.TRIM_RULES)')
+    p.add_argument('pids', nargs='*', metavar='PID',
+                   help='packet ids to trim (default: all with rules)')
+    add_input_args(p)
+
+    p = commands.add_parser('align', help='time-align columns of decoded '
+                            'CSVs into one CSV')
+    p.add_argument('streams', nargs='+', metavar='PID:COL[,COL...]',
+                   help='first stream gives the output rows')
+    p.add_argument('--how', default='backward',
+                   choices=('backward', 'forward', 'nearest'))
+    p.add_argument('--tolerance', type=float, metavar='SECONDS')
+    p.add_argument('-o', '--output', default='aligned.csv',
+                   help='output file in export directory')
+
+    p = commands.add_parser('serve', help='run resident query server')
+    p.add_argument('-i', '--input', nargs='+', default=BOXCAR_GLOBS,
+                   metavar='GLOB')
+    p.add_argument('--port', type=int,
+                   help='default: query_server.DEFAULT_PORT')
+
+    args = parser.parse_args(argv)
+
+    pid_args = getattr(args, 'pids', None) or []
+    if args.command == 'decode' and 'all' in pid_args:
+        pid_args = args.pids = sorted(packet_formats.packet_format_map)
+    unknown = [pid for pid in pid_args
+               if pid not in packet_formats.packet_format_map]
+    if unknown:
+        parser.error('unknown packet id: {}'.format(', '.join(unknown)))
+    if args.command == 'trim':
+        args.pids = args.pids or sorted(TRIM_RULES)
+        missing = [pid for pid in args.pids if pid not in TRIM_RULES]
+        if missing:
+            parser.error('no trim rules for: {}'.format(', '.join(missing)))
+    if args.command == 'align':
+        args.spec = []
+        for stream in args.streams:
+            pid, _, cols = stream.partition(':')
+            if not cols:
+                parser.error('no columns given for {}'.format(pid))
+            args.spec.append((pid, cols.split(',')))
+
+    try:
+        return run_command(args)
+    except (IOError, ValueError, KeyError) as e:
+        sys.stderr.write('{}\n'.format(e))
+        return 1
+
+
+def run_command(args):
+    """ Run parsed command line arguments of cli.
+        Returns exit status.
+    """
+    if args.command == 'inspect':
+        return inspect(args.pids, args.input)
+
+    if args.command == 'merge-evr':
+        add_evr_to_csv(args.pids)
+    elif args.command == 'align':
+        csv_aligned_packets(args.spec, args.output, args.how, args.tolerance)
+    elif args.command == 'serve':
+        import query_server
+        if args.port is None:
+            args.port = query_server.DEFAULT_PORT
+        query_server.serve(args.input, port=args.port)
+    else:
+        if args.boxcar:
+            import pandas as pd
+            bc_data = pd.read_pickle(args.boxcar)
+        else:
+            bc_data = load_ort_boxcar_data(args.input)
+
+        if args.command == 'ingest':
+            counts = bc_data['pid'].value_counts().sort_index()
+            for pid, count in counts.iteritems():
+                print '{}  {}'.format(pid, count)
+            if args.output:
+                bc_data.to_pickle(args.output)
+        elif args.command == 'decode':
+            if args.raw:
+                csv_parsed_packet_list_raw(args.pids, bc_data)
+            elif args.delta:
+                csv_parsed_packet_list_delta(args.pids, args.fields, bc_data,
+                                             args.deadband)
+            else:
+                csv_parsed_packet_list(args.pids, bc_data)
+        elif args.command == 'trim':
+            trim_packets_by_events(
+                dict((pid, TRIM_RULES[pid]) for pid in args.pids),
+                bc_data=bc_data)
+
+    return 0
+
+
+def inspect(pids=None, patterns=None):
+    """ Print packet ids and their formats, fields of pids if given, and
+        boxcar files matching patterns if given.
+        Returns exit status.
+    """
+    pformat_map = packet_formats.packet_format_map
+
+    if patterns:
+        for fname in packet_parser.find_boxcar_files(patterns):
+            print '{:>12}  {}'.format(os.path.getsize(fname), fname)
+    elif not pids:
+        for pid in sorted(pformat_map):
+            pformat = getattr(packet_formats, pformat_map[pid])
+            print '{}  {:<24}{:>4} fields'.format(pid, pformat_map[pid],
+                                                  len(pformat))
+
+    for pid in pids or []:
+        print '{}  {}'.format(pid, pformat_map[pid])
+        for field, param_type in getattr(packet_formats,
+                                         pformat_map[pid]).iteritems():
+            print '    {:<40}{}'.format(field, param_type)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -1,49 +1,79 @@
 import struct
-import bitstring
 import collections
-import csv
-import progressbar
+import glob
 import os
+import sys
+import io
+import gzip
+import threading
 import binascii
-import pandas as pd
+import codecs
 import packet_formats
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# numpy, pandas, bitstring, progressbar and csv are imported in the functions
+# using them, so the command line tool starts fast when it doesn't need them
+
 EXPORT_DIR = os.path.abspath(
-    os.path.join(os.path.dirname('__file__'), 'export'))
+    os.path.join(os.path.dirname(__file__), 'export'))
 
 RAWDATA_DIR = os.path.abspath(
-    os.path.join(os.path.dirname('__file__'), 'rawdata'))
+    os.path.join(os.path.dirname(__file__), 'rawdata'))
+
+# compressed boxcar file extensions, see open_boxcar_stream
+BOXCAR_COMPRESSED_EXTS = ('.gz', '.zst')
+
+# plain and compressed boxcar files, other extensions are not readable
+BOXCAR_GLOBS = tuple(
+    os.path.join(RAWDATA_DIR, '*_ROSA_ORT_DATA.dat' + ext)
+    for ext in ('',) + BOXCAR_COMPRESSED_EXTS)
+
+BOXCAR_READ_SIZE = 1 << 20    # bytes decompressed per chunk of lines
+BOXCAR_QUEUE_SIZE = 16        # chunks buffered ahead of the line parser
+
+BOXCAR_DATETIME_FORMAT = '%m/%d/%Y %H:%M:%S.%f'
+
+# utf-8 byte order mark left on first datetime of each boxcar file
+BOXCAR_BOM_RE = u'^(\ufeff|\xef\xbb\xbf)'
+
+# bit length of param types not written as name:length
+SPECIAL_PARAM_LENGTHS = {'motpos': 32, 'motspd': 32}
+
+# counters that change every packet - never a reason to write a delta row
+DELTA_IGNORE_FIELDS = ('datetime', 'packet_sequence_count', 'time_ms_in_week')
 
 
 def read_boxcar_file(*fnames):
-    """ Read and clean-up data from specified Boxcar file.
+    """ Read and clean-up data from specified Boxcar file. Files may be plain
+        text or gzip (.gz) / zstandard (.zst) compressed. Decompression runs
+        alongside line parsing; packets are decoded afterwards in a separate
+        pass (process_boxcar_df).
         Returns list of [timestamp, packet id, packet hex string]
     """
+    import progressbar
+
     data = []
 
     print 'Loading Boxcar Data.'
 
-    # get length of all files in list, initialize pbar
+    # progress counted in bytes read from disk, so compressed files don't
+    # need a full decompression pass just to count their lines
     total_len = 0
     for f in get_iterable(fnames):
-        total_len += get_file_len(f)
+        total_len += os.path.getsize(f)
     pbar = progressbar.ProgressBar(maxval=total_len).start()
 
     progress = 0
     for fname in get_iterable(fnames):
-        with open(fname) as f:
-            for i, l in enumerate(f):
-                pbar.update(i + progress)   # update progress bar
-                s = l.split('|')            # split file by |
-                datetime = s[0][:-2]        # trim excess space from datetime
-                packet_str = s[4][1:-1]     # trim whitespace from packet_str
-                if len(packet_str) != 128:  # ignore malformed packet_str
-                    continue
-                pid_word = '0x' + packet_str[16:20]    # word containing pid
-                pid = int(pid_word, 16) & 2047    # mask packet id from word
-                if pid != 0:    # add non-zero packet id's to data
-                    data += [[datetime, hex(pid), packet_str]]
-        progress += i   # update overall progress
+        # read/decompress in background thread while lines are parsed here
+        for pos, end, lines in prefetch(read_line_chunks(fname)):
+            data += parse_boxcar_lines(lines)
+            pbar.update(progress + pos)     # update progress bar
+        progress += os.path.getsize(fname)  # update overall progress
 
     pbar.finish()
     print 'Loading Boxcar Data Complete. Lines loaded: {}'.format(len(data))
@@ -51,6 +81,168 @@ def read_boxcar_file(*fnames):
     return data
 
 
+def read_boxcar_tail(fname, start=0):
+    """ Read boxcar file from byte start of its (decompressed) data, for
+        picking up lines appended since an earlier read. A last line without
+        newline may still be being written and is left for the next read.
+        Returns (list of [timestamp, packet id, packet hex string], byte
+        offset to continue from).
+    """
+    data = []
+    for pos, end, lines in read_line_chunks(fname, start, partial=False):
+        data += parse_boxcar_lines(lines)
+        start = end
+    return data, start
+
+
+def parse_boxcar_lines(lines):
+    """ Clean-up lines of boxcar file.
+        Returns list of [timestamp, packet id, packet hex string]
+    """
+    data = []
+    for l in lines:
+        if l.startswith(codecs.BOM_UTF8):   # first line of file
+            l = l[len(codecs.BOM_UTF8):]
+        s = l.split('|')            # split file by |
+        datetime = s[0][:-2]        # trim excess space from datetime
+        packet_str = s[4][1:-1]     # trim whitespace from packet_str
+        if len(packet_str) != 128:  # ignore malformed packet_str
+            continue
+        pid_word = '0x' + packet_str[16:20]    # word containing pid
+        pid = int(pid_word, 16) & 2047    # mask packet id from word
+        if pid != 0:    # add non-zero packet id's to data
+            data += [[datetime, hex(pid), packet_str]]
+    return data
+
+
+def open_boxcar_stream(raw_file, fname):
+    """ Wrap binary file object in decompressor picked by file extension.
+        Returns file-like object with read(size) method.
+        Raises IOError for extensions other than .dat and
+        BOXCAR_COMPRESSED_EXTS, which would otherwise parse to no lines.
+    """
+    ext = os.path.splitext(fname)[1]
+    if ext not in ('.dat',) + BOXCAR_COMPRESSED_EXTS:
+        raise IOError('unsupported boxcar file type {}: {}'
+                      .format(ext or '(no extension)', fname))
+    if fname.endswith('.gz'):
+        return gzip.GzipFile(fileobj=raw_file)
+    if fname.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise IOError('zstandard package needed to read {}'
+                          .format(fname))
+        # multi-frame files (pzstd, concatenated or appended .zst) must be
+        # read past the end of the first frame
+        return zstandard.ZstdDecompressor().stream_reader(
+            raw_file, read_across_frames=True)
+    return raw_file
+
+
+def read_line_chunks(fname, start=0, partial=True):
+    """ Read (and decompress) file in blocks of BOXCAR_READ_SIZE bytes,
+        starting at byte start of decompressed data. A last line without
+        newline is only yielded if partial.
+        Yields (bytes read from disk so far, offset in decompressed data
+        after lines, list of complete lines).
+    """
+    with open(fname, 'rb') as raw_file:
+        stream = open_boxcar_stream(raw_file, fname)
+        if stream is raw_file:
+            raw_file.seek(start)
+        else:
+            # compressed streams can't seek, decompress and drop up to start
+            skip = start
+            while skip > 0:
+                skipped = len(stream.read(min(skip, BOXCAR_READ_SIZE)))
+                if not skipped:
+                    break
+                skip -= skipped
+        end = start
+        tail = b''
+        while True:
+            block = stream.read(BOXCAR_READ_SIZE)
+            if not block:
+                break
+            block = tail + block
+            cut = block.rfind(b'\n') + 1     # keep partial line for next block
+            tail = block[cut:]
+            end += cut
+            # binary mode keeps \r\n, text mode open() used to drop the \r
+            lines = block[:cut].replace(b'\r\n', b'\n')
+            yield raw_file.tell(), end, io.BytesIO(lines).readlines()
+        if tail and partial:
+            yield raw_file.tell(), end + len(tail), [tail]
+
+
+def prefetch(iterable, maxsize=BOXCAR_QUEUE_SIZE):
+    """ Consume iterable in background thread through bounded queue, so
+        producer (disk read, decompression) runs while caller works on
+        previous items. Re-raises producer errors in caller.
+        Yields items of iterable.
+    """
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # give up if consumer has gone away, rather than block forever
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((None, item)):
+                    return
+        except Exception:
+            put((sys.exc_info()[1], None))
+            return
+        put((None, done))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            error, item = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def find_boxcar_files(patterns=BOXCAR_GLOBS):
+    """ Returns sorted list of files matching file names or glob patterns.
+        A file found both plain and compressed (X.dat, X.dat.gz) is listed
+        once, preferring plain, then BOXCAR_COMPRESSED_EXTS in order.
+    """
+    def rank(fname):
+        ext = os.path.splitext(fname)[1]
+        if ext in BOXCAR_COMPRESSED_EXTS:
+            return BOXCAR_COMPRESSED_EXTS.index(ext) + 1, fname[:-len(ext)]
+        return 0, fname
+
+    found = {}
+    for pattern in get_iter_str_list(patterns):
+        for fname in glob.glob(pattern):
+            order, plain = rank(fname)
+            if plain not in found or order < rank(found[plain])[0]:
+                found[plain] = fname
+    return sorted(found.values())
+
+
 def filter_boxcar_data(data, packet_list):
     """ Filter boxcar data for only packet IDs listed.
         Returns filtered data.
@@ -73,6 +265,8 @@ def parse_packet_str(packet_str, packet_format):
         format definition.
         Returns list with parsed information.
     """
+    import bitstring
+
     packet_bs = bitstring.ConstBitStream('0x' + packet_str)
     packet_parsed = []
 
@@ -102,11 +296,90 @@ def parse_packet_str(packet_str, packet_format):
     return packet_parsed
 
 
+def parse_packet_int(packet_str, packet_format):
+    """ Parses packet hex string like parse_packet_str, but with shifts and
+        masks on a single int instead of bitstring reads (several times
+        faster). Param types it doesn't know are still read with bitstring.
+        Returns list with parsed information.
+    """
+    packet_int = int(packet_str, 16)
+    packet_len = len(packet_str) * 4
+    packet_parsed = []
+
+    for param_type, kind, pos, length in get_packet_layout(packet_format):
+        if pos + length > packet_len:
+            raise ValueError('Packet too short for {} at bit {}'
+                             .format(param_type, pos))
+        x = (packet_int >> (packet_len - pos - length)) & ((1 << length) - 1)
+
+        if kind == 'uint':
+            val = x
+        elif kind == 'int':
+            val = x - (1 << length) if x >> (length - 1) else x
+        elif param_type == 'float:16':
+            float_str = struct.pack('I', half_to_float(x))
+            val = struct.unpack('f', float_str)[0]
+        elif param_type == 'float:32':
+            val = struct.unpack('>f', struct.pack('>I', x))[0]
+        elif param_type == 'float:64':
+            val = struct.unpack('>d', struct.pack('>Q', x))[0]
+        elif kind == 'bin':
+            val = format(x, '0{}b'.format(length))
+        elif param_type == 'text:352':
+            val = text_from_bits(bin(x))
+        elif param_type == 'motpos':
+            # 6 bits after 2 trash bits + 16 bits after 8 trash bits, signed
+            val = ((x >> 24) & 0x3f) << 16 | (x & 0xffff)
+            if val >> 21:
+                val -= 1 << 22
+        elif param_type == 'motspd':
+            val = ((x >> 8) & 0xff) >> 2
+        else:
+            import bitstring
+            packet_bs = bitstring.ConstBitStream('0x' + packet_str)
+            packet_bs.pos = pos
+            val = packet_bs.read(param_type)
+
+        packet_parsed.append(val)
+
+    return packet_parsed
+
+
+def get_packet_layout(packet_format, _cache={}):
+    """ Returns list of (param type, kind, bit offset, bit length) for each
+        param of packet format, kind being the part of param type before ':'.
+    """
+    try:
+        cached_format, layout = _cache[id(packet_format)]
+        if cached_format is packet_format:
+            return layout
+    except KeyError:
+        pass
+
+    layout = []
+    pos = 0
+    for param_type in packet_format.itervalues():
+        kind, _, length = param_type.partition(':')
+        if param_type in SPECIAL_PARAM_LENGTHS:
+            length = SPECIAL_PARAM_LENGTHS[param_type]
+        elif kind == 'bytes':
+            length = int(length) * 8
+        else:
+            length = int(length)
+        layout.append((param_type, kind, pos, length))
+        pos += length
+
+    _cache[id(packet_format)] = (packet_format, layout)
+    return layout
+
+
 def parse_packet_list(packets, packet_format):
     """ Takes a list of packets in boxcar format and parses them to
         specified format definition.
         Returns list of [timestamp, parsed data...] including header row.
     """
+    import progressbar
+
     parsed_data = []
 
     print 'Parsing Data.'
@@ -135,6 +408,8 @@ def process_boxcar_df(boxcar_df, pid, pformat):
         and parses according to packet format (pformat)
         Returns parsed data frame
     """
+    import pandas as pd
+
     pid = get_iter_str_list(pid)
 
     # filter only specified packets
@@ -150,9 +425,145 @@ def process_boxcar_df(boxcar_df, pid, pformat):
     return pd.DataFrame(data[1:], columns=data[0])
 
 
+def delta_compress_df(parsed_df, fields=None, ignore=DELTA_IGNORE_FIELDS,
+                      deadband=None):
+    """ Reduce parsed DataFrame to change-only (run-length) form. A row is
+        kept only when one of fields differs from the previous packet;
+        fields defaults to all columns not listed in ignore. Optional
+        deadband maps analog fields to a tolerance, those only count as
+        changed once they move more than tolerance from the value in the
+        last kept row (lossy, values then within tolerance).
+        Returns DataFrame of first packet of each run, with original row
+        index and added run_length (packets represented by row) and run_end
+        (datetime of last packet of run) columns.
+    """
+    import numpy as np
+
+    if deadband is None:
+        deadband = {}
+    if fields is None:
+        fields = [col for col in parsed_df.columns if col not in ignore]
+    fields = list(get_iter_str_list(fields))
+
+    values = parsed_df[[f for f in fields if f not in deadband]]
+    prev = values.shift()
+
+    # NaN != NaN, so treat two missing values in a row as unchanged
+    changed = (values != prev) & ~(values.isnull() & prev.isnull())
+    run_starts = changed.any(axis=1).values
+    if len(run_starts):
+        run_starts[0] = True
+
+    banded = [f for f in fields if f in deadband]
+    if banded:
+        run_starts = _deadband_run_starts(
+            run_starts, parsed_df[banded].values.astype(float),
+            np.array([deadband[f] for f in banded], dtype=float))
+
+    run_start_idx = np.flatnonzero(run_starts)
+    run_end_idx = np.append(run_start_idx, len(parsed_df))[1:] - 1
+    delta_df = parsed_df.iloc[run_start_idx].copy()
+    delta_df['run_length'] = run_end_idx - run_start_idx + 1
+    delta_df['run_end'] = parsed_df['datetime'].values[run_end_idx]
+
+    return delta_df
+
+
+def _deadband_run_starts(run_starts, values, bands):
+    """ Returns run_starts with a run also started at each row of values
+        that moved more than bands from the last run start (or became/
+        stopped being NaN). Loops once per run, searching ahead for the next
+        move in doubling blocks of rows up to the next existing run start.
+    """
+    import numpy as np
+
+    n = len(values)
+    starts = np.flatnonzero(run_starts)
+    missing = np.isnan(values)
+    kept = []
+
+    i = 0
+    with np.errstate(invalid='ignore'):
+        while i < n:
+            kept.append(i)
+            k = np.searchsorted(starts, i, 'right')
+            limit = starts[k] if k < len(starts) else n
+            lo, block = i + 1, 64
+            i = limit
+            while lo < limit:
+                hi = min(lo + block, limit)
+                moved = ((np.abs(values[lo:hi] - values[kept[-1]]) > bands) |
+                         (missing[lo:hi] != missing[kept[-1]]))
+                hits = np.flatnonzero(moved.any(axis=1))
+                if len(hits):
+                    i = lo + hits[0]
+                    break
+                lo, block = hi, block * 2
+
+    run_starts = np.zeros(n, dtype=bool)
+    run_starts[kept] = True
+    return run_starts
+
+
+def expand_delta_df(delta_df, datetimes=None):
+    """ Expand change-only DataFrame back to one row per packet. Packet
+        times inside each run are spread evenly from its datetime to its
+        run_end; fields left out of change detection (counters) repeat the
+        value of the first packet of the run.
+        With datetimes, returns values in effect at each of datetimes
+        instead, NaN before first row.
+        Returns DataFrame without run_length and run_end columns.
+    """
+    import numpy as np
+    import pandas as pd
+
+    values_df = delta_df.drop(['run_length', 'run_end'], axis=1) \
+        .reset_index(drop=True)
+
+    if datetimes is None:
+        lengths = delta_df['run_length'].values
+        rows = np.repeat(np.arange(len(delta_df)), lengths)
+        expanded_df = values_df.iloc[rows].reset_index(drop=True)
+
+        # spread times of packets inside each run evenly over it
+        ends = np.cumsum(lengths) - 1
+        pos = np.arange(len(rows)) - np.repeat(ends - lengths + 1, lengths)
+        start = to_timestamp_ns(delta_df['datetime'])
+        end = to_timestamp_ns(delta_df['run_end'])
+        period = (end - start) // np.maximum(lengths - 1, 1)
+        times = start[rows] + pos * period[rows]
+
+        # same text format as boxcar datetimes (4 decimal places), first
+        # and last packet of each run keep their original text
+        texts = np.array([t[:-2] for t in pd.DatetimeIndex(times)
+                          .strftime(BOXCAR_DATETIME_FORMAT)], dtype=object)
+        texts[ends] = delta_df['run_end'].values
+        texts[ends - lengths + 1] = delta_df['datetime'].values
+        expanded_df['datetime'] = texts
+        return expanded_df
+
+    run_times = to_timestamp_ns(delta_df['datetime'])
+    rows = np.searchsorted(run_times, to_timestamp_ns(datetimes),
+                           side='right') - 1
+
+    # row -1 (before first packet) isn't in index, reindex fills with NaN
+    expanded_df = values_df.reindex(rows).reset_index(drop=True)
+    expanded_df['datetime'] = np.asarray(get_iter_str_list(datetimes))
+    return expanded_df
+
+
+def delta_value_at(delta_df, datetime):
+    """ Returns Series of values in effect at specified time from
+        change-only DataFrame.
+    """
+    return expand_delta_df(delta_df, [datetime]).iloc[0]
+
+
 def output_to_csv(data, outfile='output.csv'):
     """ Outputs list of data to CSV file
     """
+    import csv
+
     filepath = os.path.join(EXPORT_DIR, outfile)
 
     with open(filepath, 'wb') as myfile:
@@ -218,8 +629,19 @@ def get_iter_str_list(x):
     return x
 
 
-def get_file_len(fname):
-    with open(fname) as f:
-        for i, l in enumerate(f):
-            pass
-    return i + 1
+def to_timestamp_ns(datetimes):
+    """ Convert boxcar datetime strings (or anything else pandas reads as
+        a time) to int64 nanoseconds for fast sorting and searching.
+        Returns numpy int64 array.
+    """
+    import pandas as pd
+
+    datetimes = pd.Series(get_iter_str_list(datetimes))
+    if datetimes.dtype == object:
+        strings = datetimes.str.replace(BOXCAR_BOM_RE, '')
+        datetimes = strings.where(strings.notnull(), datetimes)
+    try:
+        stamps = pd.to_datetime(datetimes, format=BOXCAR_DATETIME_FORMAT)
+    except (ValueError, TypeError):
+        stamps = pd.to_datetime(datetimes)
+    return stamps.values.astype('int64')
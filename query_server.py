@@ -0,0 +1,414 @@
+""" Resident query service for decoded telemetry.
+
+    Loads boxcar data once, decodes packet ids on first use and keeps both in
+    memory, picking up new boxcar files and lines appended to them. Answers
+    queries over localhost HTTP:
+
+        GET /query?pid=0x408&columns=damper_voltage_1,temperature_1_left_damper
+                  &start=2016-09-27 13:00&stop=2016-09-27 14:00
+        GET /status
+
+    Query results come back in a simple binary columnar format (see
+    encode_columnar) and are kept in an LRU cache, so repeat queries don't
+    touch the DataFrames at all. Use query() as the client.
+"""
+import collections
+import glob
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import numpy as np
+import pandas as pd
+import packet_formats
+import packet_parser
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import urlencode
+    from urllib2 import urlopen, HTTPError
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.error import HTTPError
+    from urllib.parse import urlencode, urlparse, parse_qs
+    from urllib.request import urlopen
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8427
+
+RESULT_CACHE_BYTES = 256 << 20  # size of encoded query results kept
+RELOAD_INTERVAL = 30.0          # seconds between checks for new boxcar data
+
+COLUMNAR_MAGIC = b'ORTC'
+
+
+class LRUCache(object):
+    """ Thread-safe least recently used cache of byte strings, limited to
+        maxbytes total length.
+    """
+    def __init__(self, maxbytes=RESULT_CACHE_BYTES):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value    # move to most recently used
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old)
+            if len(value) > self.maxbytes:
+                return      # would evict everything else, don't keep
+            self._items[key] = value
+            self.nbytes += len(value)
+            while self.nbytes > self.maxbytes:
+                self.nbytes -= len(self._items.popitem(last=False)[1])
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+
+class TelemetryStore(object):
+    """ Boxcar data and decoded packets held in memory.
+        Takes list of file names or glob patterns of boxcar files.
+    """
+    def __init__(self, patterns, cache_bytes=RESULT_CACHE_BYTES):
+        self.patterns = packet_parser.get_iter_str_list(patterns)
+        self.cache = LRUCache(cache_bytes)
+        self.generation = 0         # bumped whenever data changes
+        # file name -> (mtime, size, offset in data of next unread line)
+        self.file_state = collections.OrderedDict()
+        self.boxcar_df = pd.DataFrame(columns=['datetime', 'pid',
+                                               'packet_str'])
+        self.decoded = {}
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self):
+        """ Read lines appended to boxcar files since last refresh, and any
+            new files. Everything is reloaded if a file shrank or went away.
+            Returns True if data changed.
+        """
+        with self._refresh_lock:
+            return self._refresh()
+
+    def _refresh(self):
+        stats = collections.OrderedDict(
+            (f, (os.path.getmtime(f), os.path.getsize(f)))
+            for f in packet_parser.find_boxcar_files(self.patterns))
+
+        reload_all = any(f not in stats or stats[f][1] < size
+                         for f, (mtime, size, offset)
+                         in self.file_state.items())
+        old_state = {} if reload_all else self.file_state
+
+        # read and decode outside the lock so queries are answered meanwhile
+        state = collections.OrderedDict()
+        new_data = []
+        for f, stat in stats.items():
+            offset = 0
+            if f in old_state:
+                offset = old_state[f][2]
+                if old_state[f][:2] == stat:
+                    state[f] = old_state[f]
+                    continue
+            data, offset = packet_parser.read_boxcar_tail(f, offset)
+            new_data += data
+            state[f] = stat + (offset,)
+
+        if not new_data and not reload_all:
+            with self._lock:
+                self.file_state = state
+            return False
+
+        new_df = pd.DataFrame(new_data,
+                              columns=['datetime', 'pid', 'packet_str'])
+        with self._lock:
+            decoded = {} if reload_all else dict(self.decoded)
+        # only decode the new rows for packets already decoded
+        for pid, decoded_df in decoded.items():
+            decoded[pid] = self._sort_by_time(pd.concat(
+                [decoded_df, self._decode(new_df, pid)], ignore_index=True))
+
+        with self._lock:
+            if reload_all:
+                self.boxcar_df = new_df
+            else:
+                self.boxcar_df = pd.concat([self.boxcar_df, new_df],
+                                           ignore_index=True)
+            # packets first decoded meanwhile lack new rows, decode again
+            # when next asked for
+            self.decoded = decoded
+            self.file_state = state
+            self.generation += 1
+            self.cache.clear()
+        return True
+
+    def get_decoded(self, pid):
+        """ Returns decoded DataFrame for packet id, with int64 timestamp
+            column, sorted by time. Decodes on first request.
+        """
+        with self._lock:
+            decoded_df = self.decoded.get(pid)
+            boxcar_df, generation = self.boxcar_df, self.generation
+        if decoded_df is not None:
+            return decoded_df
+
+        # decode outside the lock so queries for other packets go on
+        decoded_df = self._sort_by_time(self._decode(boxcar_df, pid))
+        with self._lock:
+            if self.generation != generation:
+                return decoded_df   # data changed meanwhile, don't keep
+            return self.decoded.setdefault(pid, decoded_df)
+
+    def query(self, pid, columns=None, start=None, stop=None):
+        """ Returns columnar encoded bytes of columns (default all) of pid
+            between start and stop times (inclusive, default unbounded).
+        """
+        if columns is not None:
+            columns = tuple(packet_parser.get_iter_str_list(columns))
+        key = (self.generation, pid, columns, start, stop)
+
+        result = self.cache.get(key)
+        if result is None:
+            decoded_df = self.get_decoded(pid)
+            times = decoded_df['timestamp'].values
+            lo, hi = 0, len(times)
+            if start is not None:
+                lo = np.searchsorted(
+                    times, packet_parser.to_timestamp_ns(start)[0], 'left')
+            if stop is not None:
+                hi = np.searchsorted(
+                    times, packet_parser.to_timestamp_ns(stop)[0], 'right')
+
+            if columns is None:
+                columns = tuple(decoded_df.columns)
+            elif 'datetime' not in columns:
+                columns = ('datetime',) + columns
+            missing = [col for col in columns if col not in decoded_df]
+            if missing:
+                raise KeyError('Unknown columns for {}: {}'
+                               .format(pid, ', '.join(missing)))
+
+            result = encode_columnar(decoded_df[list(columns)].iloc[lo:hi])
+            self.cache.put(key, result)
+
+        return result
+
+    def status(self):
+        """ Returns dict describing loaded data.
+        """
+        with self._lock:
+            return {'generation': self.generation,
+                    'files': list(self.file_state),
+                    'packets': len(self.boxcar_df),
+                    'decoded': dict((pid, len(df)) for pid, df
+                                    in self.decoded.items()),
+                    'cached_results': len(self.cache),
+                    'cached_bytes': self.cache.nbytes}
+
+    @staticmethod
+    def _decode(boxcar_df, pid):
+        pformat = getattr(packet_formats,
+                          packet_formats.packet_format_map[pid])
+        if boxcar_df['pid'].isin([pid]).any():
+            decoded_df = packet_parser.process_boxcar_df(boxcar_df, pid,
+                                                         pformat)
+        else:
+            decoded_df = pd.DataFrame(columns=['datetime'] + list(pformat))
+        decoded_df['timestamp'] = packet_parser.to_timestamp_ns(
+            decoded_df['datetime'])
+        return decoded_df
+
+    @staticmethod
+    def _sort_by_time(decoded_df):
+        if decoded_df['timestamp'].is_monotonic:
+            return decoded_df
+        return decoded_df.sort_values(by='timestamp', kind='mergesort') \
+            .reset_index(drop=True)
+
+
+# COLUMNAR WIRE FORMAT
+
+def encode_columnar(df):
+    """ Encode DataFrame as bytes:
+            magic b'ORTC', uint32 little-endian header length, JSON header
+            {'rows': n, 'columns': [{'name': .., 'dtype': ..}, ...]},
+            then each column as raw numpy buffer in header order.
+        Text columns are sent as fixed width utf-8 byte strings (byte
+        strings are taken as utf-8, not ascii).
+    """
+    header = {'rows': len(df), 'columns': []}
+    buffers = []
+    for name in df.columns:
+        values = df[name].values
+        if values.dtype == object:
+            text = [v.decode('utf-8', 'replace') if isinstance(v, bytes)
+                    else v for v in values]
+            values = np.char.encode(np.array(text, dtype=np.unicode_),
+                                    'utf-8')
+        header['columns'].append({'name': name, 'dtype': values.dtype.str})
+        buffers.append(np.ascontiguousarray(values).tobytes())
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    return b''.join([COLUMNAR_MAGIC, struct.pack('<I', len(header_bytes)),
+                     header_bytes] + buffers)
+
+
+def decode_columnar(data):
+    """ Decode bytes from encode_columnar.
+        Returns DataFrame.
+    """
+    if data[:4] != COLUMNAR_MAGIC:
+        raise ValueError('Not a columnar telemetry result')
+    header_len = struct.unpack('<I', data[4:8])[0]
+    header = json.loads(data[8:8 + header_len].decode('utf-8'))
+
+    offset = 8 + header_len
+    columns = collections.OrderedDict()
+    for col in header['columns']:
+        dtype = np.dtype(str(col['dtype']))
+        values = np.frombuffer(data, dtype, header['rows'], offset)
+        offset += dtype.itemsize * header['rows']
+        if dtype.kind == 'S':
+            values = np.char.decode(values, 'utf-8')
+        columns[col['name']] = values
+    return pd.DataFrame(columns)
+
+
+def check_columnar(fnames):
+    """ Round trip parsed CSV files through encode_columnar and
+        decode_columnar, printing any column that doesn't come back equal.
+        Returns number of mismatched columns.
+    """
+    failures = 0
+    for fname in fnames:
+        df = pd.read_csv(fname, index_col=0)
+        decoded_df = decode_columnar(encode_columnar(df))
+        for name in df.columns:
+            values = df[name].values
+            if values.dtype == object:
+                # bytes come back as utf-8 decoded text
+                values = np.array(
+                    [v.decode('utf-8', 'replace') if isinstance(v, bytes)
+                     else v for v in values], dtype=np.unicode_)
+            decoded = decoded_df[name].values
+            if not pd.Series(values).equals(pd.Series(decoded)):
+                print 'MISMATCH: {} {}'.format(fname, name)
+                failures += 1
+        print '{:<50}{:>8} rows checked'.format(fname, len(df))
+    return failures
+
+
+# SERVER
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    store = None    # TelemetryStore, set by serve()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        args = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+
+        try:
+            if url.path == '/query':
+                columns = args.get('columns')
+                if columns is not None:
+                    columns = columns.split(',')
+                body = self.store.query(args['pid'], columns,
+                                        args.get('start'), args.get('stop'))
+                self._send(200, 'application/octet-stream', body)
+            elif url.path == '/status':
+                self._send(200, 'application/json',
+                           json.dumps(self.store.status()).encode('utf-8'))
+            else:
+                self._send(404, 'text/plain', b'Unknown path')
+        except (KeyError, ValueError) as e:
+            self._send(400, 'text/plain', str(e).encode('utf-8'))
+        except Exception as e:
+            self._send(500, 'text/plain', repr(e).encode('utf-8'))
+
+    def _send(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass    # keep console for load progress
+
+
+def serve(patterns=packet_parser.BOXCAR_GLOBS, host=DEFAULT_HOST,
+          port=DEFAULT_PORT, reload_interval=RELOAD_INTERVAL):
+    """ Load boxcar files matching patterns and answer queries until killed.
+        Checks for new boxcar data every reload_interval seconds.
+    """
+    store = TelemetryStore(patterns)
+    store.refresh()
+
+    def reload_loop():
+        while True:
+            time.sleep(reload_interval)
+            store.refresh()
+
+    reloader = threading.Thread(target=reload_loop)
+    reloader.daemon = True
+    reloader.start()
+
+    QueryHandler.store = store
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    print 'Serving telemetry queries on http://{}:{}'.format(host, port)
+    server.serve_forever()
+
+
+# CLIENT
+
+def query(pid, columns=None, start=None, stop=None, host=DEFAULT_HOST,
+          port=DEFAULT_PORT):
+    """ Query running server for columns of pid between start and stop.
+        Returns DataFrame.
+    """
+    args = {'pid': pid}
+    if columns is not None:
+        args['columns'] = ','.join(packet_parser.get_iter_str_list(columns))
+    if start is not None:
+        args['start'] = start
+    if stop is not None:
+        args['stop'] = stop
+
+    url = 'http://{}:{}/query?{}'.format(host, port, urlencode(args))
+    try:
+        return decode_columnar(urlopen(url).read())
+    except HTTPError as e:
+        raise ValueError(e.read())
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--check']:
+        # python query_server.py --check [parsed CSV ...]
+        sys.exit(check_columnar(sys.argv[2:] or sorted(glob.glob(
+            os.path.join(packet_parser.EXPORT_DIR, '*_parsed.csv')))) > 0)
+    serve(sys.argv[1:] or packet_parser.BOXCAR_GLOBS)